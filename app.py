@@ -1,121 +1,254 @@
-import os
-import re
-import pandas as pd
-from flask import Flask, request, jsonify
-from flask_cors import CORS  # Enable CORS for external requests
-from dotenv import load_dotenv
-import logging
-import sys
-
-# Configure logging
-def get_logger(logger_name):
-    logger = logging.getLogger(logger_name)
-    logger.setLevel(logging.DEBUG)
-    handler = logging.StreamHandler(sys.stdout)
-    handler.setLevel(logging.DEBUG)
-    handler.setFormatter(
-        logging.Formatter('%(name)s [%(asctime)s] [%(levelname)s] %(message)s'))
-    logger.addHandler(handler)
-    return logger
-
-logger = get_logger('Flask-App')
-
-# Load environment variables
-load_dotenv()
-
-# Import functions from utils.py
-from utils import (
-    create_connection,
-    get_snowflake_metadata,
-    query_snowflake,
-    visual_generate,
-    llm
-)
-
-# Initialize Flask App
-app = Flask(__name__)
-
-# Enable CORS for all domains (Required for Snowflake)
-CORS(app)
-
-# ✅ Health Check Endpoint
-@app.route('/health', methods=['GET'])
-def health_check():
-    return jsonify({"status": "running"}), 200
-
-# ✅ API to Query Snowflake (Supports both GET and POST)
-@app.route('/getdata', methods=['GET', 'POST'])
-def query_api():
-    logger.debug("Received request on /getdata")
-
-    # Determine if the request is GET or POST
-    if request.method == 'POST':
-        data = request.get_json()
-        user_question = data.get("data") if data else None
-    elif request.method == 'GET':
-        user_question = request.args.get("data")  # Get query param ?data=
-
-    if not user_question:
-        logger.warning("⚠️ No query provided in request")
-        return jsonify({"message": "No user_question provided", "result": {}}), 400
-
-    # 1. Create Snowflake connection
-    conn = create_connection()
-
-    # 2. Retrieve metadata
-    snowflake_metadata = get_snowflake_metadata(conn)
-    if not snowflake_metadata:
-        conn.close()
-        return jsonify({"message": "Metadata retrieval failed.", "result": {}}), 500
-
-    # 3. Read system instructions (prompt) from file
-    try:
-        with open("instructions.txt", "r", encoding="utf-8") as file:
-            system_prompt = file.read().strip()
-    except FileNotFoundError:
-        return jsonify({"message": "Instructions file not found"}), 500
-
-    # 4. Generate SQL using LLM
-    metadata_prompt = f"{system_prompt}\n\nUser Question:\n{user_question}"
-    try:
-        llm_response = llm.invoke(metadata_prompt).content.strip()
-        sql_match = re.search(r"```sql\n(.*?)\n```", llm_response, re.DOTALL)
-        if sql_match:
-            sql_query = sql_match.group(1).strip()
-        else:
-            conn.close()
-            return jsonify({"message": "Invalid SQL generated.", "result": {}}), 500
-    except Exception as e:
-        conn.close()
-        return jsonify({"message": f"Error generating SQL: {str(e)}", "result": {}}), 500
-
-    # 5. Execute SQL in Snowflake
-    result_df = query_snowflake(conn, sql_query)
-    conn.close()
-
-    if result_df.empty:
-        return jsonify({
-            "message": "Query returned no data.",
-            "result": [],
-            "chart_html": ""
-        }), 200
-
-    # 6. Generate an explanation from LLM
-    explanation_prompt = f"Explain these results: {result_df.head(10).to_json()}"
-    explanation_response = llm.invoke(explanation_prompt).content.strip()
-
-    # 7. Generate visualization
-    chart_html = visual_generate(sql_query, result_df.to_dict(orient="records"), explanation_response)
-
-    return jsonify({
-        "message": explanation_response,
-        "result": result_df.to_dict(orient="records"),
-        "chart_html": chart_html
-    })
-
-# Set dynamic port from environment or default to 8080
-port = int(os.getenv("SERVER_PORT", 8080))
-
-# ✅ Ensure Flask binds to all interfaces
-if __name__ == '__main__':
-    app.run(host="0.0.0.0", port=port, debug=True)
+import os
+import asyncio
+import orjson
+from concurrent.futures import ProcessPoolExecutor
+from fastapi import FastAPI, Request
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from fastapi.middleware.cors import CORSMiddleware
+from langchain_core.messages import SystemMessage, HumanMessage
+from dotenv import load_dotenv
+import logging
+import sys
+import uvicorn
+
+# Configure logging (INFO by default; set LOG_LEVEL=DEBUG for verbose per-request logs)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+def get_logger(logger_name):
+    logger = logging.getLogger(logger_name)
+    logger.setLevel(LOG_LEVEL)
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setLevel(LOG_LEVEL)
+    handler.setFormatter(
+        logging.Formatter('%(name)s [%(asctime)s] [%(levelname)s] %(message)s'))
+    logger.addHandler(handler)
+    return logger
+
+logger = get_logger('FastAPI-App')
+
+# Load environment variables
+load_dotenv()
+
+# Import functions from utils.py
+from utils import (
+    aget_conn,
+    get_snowflake_metadata,
+    is_safe_select,
+    query_snowflake,
+    visual_generate,
+    llm
+)
+
+class DataResponse(ORJSONResponse):
+    """ORJSONResponse that stringifies types orjson can't serialize natively
+    (pd.Timestamp and Decimal values coming out of Snowflake result sets)."""
+    def render(self, content):
+        return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY, default=str)
+
+# Initialize FastAPI App (async so the event loop serves other requests during LLM calls)
+app = FastAPI(default_response_class=DataResponse)
+
+# Enable CORS for all domains (Required for Snowflake)
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+# ✅ Load system instructions (prompt) once at import instead of per request
+def load_system_prompt(path="instructions.txt"):
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            return file.read().strip()
+    except FileNotFoundError:
+        logger.error("🚨 Instructions file not found!")
+        return None
+
+SYSTEM_PROMPT = load_system_prompt()
+
+# 🔹 Chart generation is GIL-bound CPU work (Plotly figure build + HTML
+# serialization); run it in worker processes so it uses other cores instead
+# of stalling the server. Keep the per-worker pool small — gunicorn already
+# runs (2 * cores) + 1 app workers, each with its own pool.
+_CHART_POOL = ProcessPoolExecutor(max_workers=int(os.getenv("CHART_POOL_WORKERS", 2)))
+
+# ✅ Health Check Endpoint
+@app.get('/health')
+async def health_check():
+    return {"status": "running"}
+
+# ✅ API to Query Snowflake (Supports both GET and POST)
+@app.api_route('/getdata', methods=['GET', 'POST'])
+async def query_api(request: Request):
+    logger.debug("Received request on /getdata")
+
+    # Determine if the request is GET or POST
+    if request.method == 'POST':
+        try:
+            data = await request.json()
+        except Exception:
+            data = None
+        user_question = data.get("data") if data else None
+    else:
+        user_question = request.query_params.get("data")  # Get query param ?data=
+
+    if not user_question:
+        logger.warning("⚠️ No query provided in request")
+        return DataResponse({"message": "No user_question provided", "result": {}}, status_code=400)
+
+    # 1. Borrow a pooled Snowflake connection (auth on a pool miss runs in a thread)
+    async with aget_conn() as conn:
+        # 2. Retrieve metadata (blocking Snowflake call moved off the event loop)
+        snowflake_metadata = await asyncio.to_thread(get_snowflake_metadata, conn)
+        if not snowflake_metadata:
+            return DataResponse({"message": "Metadata retrieval failed.", "result": {}}, status_code=500)
+
+        # 3. Check system instructions (prompt) loaded at import
+        if SYSTEM_PROMPT is None:
+            return DataResponse({"message": "Instructions file not found"}, status_code=500)
+
+        # 4. Generate SQL using LLM (awaitable so other requests proceed meanwhile).
+        # The system prompt goes in its own message and stays byte-identical across
+        # requests so Azure's server-side prompt cache can reuse the static prefix.
+        metadata_prompt = [
+            SystemMessage(content=SYSTEM_PROMPT),
+            HumanMessage(content=user_question)
+        ]
+        try:
+            llm_response = (await llm.ainvoke(metadata_prompt)).content.strip()
+            # Extract the ```sql ... ``` fence without the regex engine
+            _, _, fence_tail = llm_response.partition("```sql\n")
+            sql_query, _, _ = fence_tail.partition("\n```")
+            sql_query = sql_query.strip()
+            if not sql_query:
+                return DataResponse({"message": "Invalid SQL generated.", "result": {}}, status_code=500)
+        except Exception as e:
+            return DataResponse({"message": f"Error generating SQL: {str(e)}", "result": {}}, status_code=500)
+
+        # Reject non-SELECT statements before spending a warehouse round-trip
+        if not is_safe_select(sql_query):
+            return DataResponse({"message": "Generated SQL is not a read-only query.", "result": {}}, status_code=400)
+
+        # 5. Execute SQL in Snowflake
+        result_df = await asyncio.to_thread(query_snowflake, conn, sql_query)
+
+    if result_df.empty:
+        return DataResponse({
+            "message": "Query returned no data.",
+            "result": [],
+            "chart_html": ""
+        })
+
+    # Materialize the records once; reused for the prompt, the chart and the response
+    result_list = result_df.to_dict(orient="records")
+
+    # 6 & 7. Generate the explanation and the visualization concurrently —
+    # the chart doesn't depend on the explanation text.
+    # Feed the LLM a compact CSV sample (5 rows x 8 columns) — roughly 3x fewer
+    # tokens than the JSON equivalent for tabular data
+    summary = result_df.iloc[:5, :8].to_csv(index=False)
+    explanation_prompt = f"Explain these results in one sentence:\n{summary}"
+    explanation_result, chart_html = await asyncio.gather(
+        llm.ainvoke(explanation_prompt),
+        asyncio.get_running_loop().run_in_executor(
+            _CHART_POOL, visual_generate, sql_query, result_list, ""
+        )
+    )
+    explanation_response = explanation_result.content.strip()
+
+    return DataResponse({
+        "message": explanation_response,
+        "result": result_list,
+        "chart_html": chart_html
+    })
+
+def sse_event(event, payload):
+    """Format one Server-Sent Event with a JSON payload."""
+    data = orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY, default=str).decode()
+    return f"event: {event}\ndata: {data}\n\n"
+
+# ✅ Streaming variant of /getdata: emits SQL and explanation tokens as they
+# arrive, so the client sees progress at first-token time instead of waiting
+# for both LLM calls to finish
+@app.api_route('/getdata/stream', methods=['GET', 'POST'])
+async def query_api_stream(request: Request):
+    logger.debug("Received request on /getdata/stream")
+
+    if request.method == 'POST':
+        try:
+            data = await request.json()
+        except Exception:
+            data = None
+        user_question = data.get("data") if data else None
+    else:
+        user_question = request.query_params.get("data")
+
+    async def event_stream():
+        if not user_question:
+            yield sse_event("error", {"message": "No user_question provided"})
+            return
+
+        if SYSTEM_PROMPT is None:
+            yield sse_event("error", {"message": "Instructions file not found"})
+            return
+
+        async with aget_conn() as conn:
+            snowflake_metadata = await asyncio.to_thread(get_snowflake_metadata, conn)
+            if not snowflake_metadata:
+                yield sse_event("error", {"message": "Metadata retrieval failed."})
+                return
+
+            metadata_prompt = [
+                SystemMessage(content=SYSTEM_PROMPT),
+                HumanMessage(content=user_question)
+            ]
+            llm_response = ""
+            try:
+                async for chunk in llm.astream(metadata_prompt):
+                    if chunk.content:
+                        llm_response += chunk.content
+                        yield sse_event("sql_token", {"token": chunk.content})
+            except Exception as e:
+                yield sse_event("error", {"message": f"Error generating SQL: {str(e)}"})
+                return
+
+            _, _, fence_tail = llm_response.strip().partition("```sql\n")
+            sql_query, _, _ = fence_tail.partition("\n```")
+            sql_query = sql_query.strip()
+            if not sql_query:
+                yield sse_event("error", {"message": "Invalid SQL generated."})
+                return
+            if not is_safe_select(sql_query):
+                yield sse_event("error", {"message": "Generated SQL is not a read-only query."})
+                return
+            yield sse_event("sql", {"sql": sql_query})
+
+            result_df = await asyncio.to_thread(query_snowflake, conn, sql_query)
+
+        if result_df.empty:
+            yield sse_event("result", {"result": []})
+            return
+
+        result_list = result_df.to_dict(orient="records")
+        yield sse_event("result", {"result": result_list})
+
+        # Kick off chart generation while the explanation streams
+        chart_task = asyncio.get_running_loop().run_in_executor(
+            _CHART_POOL, visual_generate, sql_query, result_list, ""
+        )
+        summary = result_df.iloc[:5, :8].to_csv(index=False)
+        async for chunk in llm.astream(f"Explain these results in one sentence:\n{summary}"):
+            if chunk.content:
+                yield sse_event("explanation", {"token": chunk.content})
+
+        yield sse_event("chart", {"chart_html": await chart_task})
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+# Set dynamic port from environment or default to 8080
+port = int(os.getenv("SERVER_PORT", 8080))
+
+# ✅ Ensure the ASGI server binds to all interfaces
+if __name__ == '__main__':
+    uvicorn.run(app, host="0.0.0.0", port=port)
@@ -0,0 +1,10 @@
+import os
+
+# (2 * cores) + 1 workers; each uvicorn worker multiplexes many in-flight
+# LLM requests on its event loop
+workers = (2 * os.cpu_count()) + 1
+worker_class = "uvicorn.workers.UvicornWorker"
+bind = f"0.0.0.0:{os.getenv('SERVER_PORT', 8080)}"
+
+# LLM completions can take up to ~30s; don't kill workers mid-request
+timeout = 120
@@ -1,190 +1,339 @@
-import os
-import pandas as pd
-import snowflake.connector
-import plotly.express as px
-import plotly.io as pio
-from dotenv import load_dotenv
-from langchain_openai import AzureChatOpenAI
-import logging
-import sys
-
-# 🔹 Configure Logger
-def get_logger(logger_name):
-    logger = logging.getLogger(logger_name)
-    logger.setLevel(logging.DEBUG)
-    handler = logging.StreamHandler(sys.stdout)
-    handler.setLevel(logging.DEBUG)
-    handler.setFormatter(logging.Formatter('%(name)s [%(asctime)s] [%(levelname)s] %(message)s'))
-    logger.addHandler(handler)
-    return logger
-
-logger = get_logger('snowflake-service')
-
-# 🔹 Load environment variables
-logger.debug("Loading environment variables...")
-load_dotenv()
-
-# 🔹 Retrieve Azure OpenAI credentials
-api_key = os.getenv("OPENAI_API_KEY")
-deployment_name = os.getenv("AZURE_DEPLOYMENT_NAME")
-api_version = os.getenv("AZURE_API_VERSION")
-azure_endpoint = os.getenv("AZURE_ENDPOINT")
-
-# 🔹 Initialize Azure OpenAI
-logger.debug("Initializing Azure OpenAI Model...")
-try:
-    llm = AzureChatOpenAI(
-        openai_api_key=api_key,
-        azure_endpoint=azure_endpoint,
-        deployment_name=deployment_name,
-        api_version=api_version,
-        temperature=0.0
-    )
-    logger.debug("✅ Azure OpenAI Model initialized successfully!")
-except Exception as e:
-    logger.error(f"🚨 Failed to Initialize Azure OpenAI Model: {e}")
-    raise
-
-# 🔹 Retrieve Snowflake credentials (Ensure no password for OAuth inside Snowflake)
-SNOWFLAKE_USER = os.getenv("SNOWFLAKE_USER")
-SNOWFLAKE_PASSWORD = os.getenv("SNOWFLAKE_PASSWORD")  # Used for local testing
-SNOWFLAKE_ACCOUNT = os.getenv("SNOWFLAKE_ACCOUNT")
-SNOWFLAKE_WAREHOUSE = os.getenv("SNOWFLAKE_WAREHOUSE")
-SNOWFLAKE_DATABASE = os.getenv("SNOWFLAKE_DATABASE")
-SNOWFLAKE_SCHEMA = os.getenv("SNOWFLAKE_SCHEMA")
-SNOWFLAKE_HOST = os.getenv("SNOWFLAKE_HOST")
-
-def get_login_token():
-    """
-    Retrieve the short-lived Snowflake OAuth token if running inside Snowflake Container Services.
-    If running locally, return None.
-    """
-    token_path = "/snowflake/session/token"
-    if os.path.exists(token_path):
-        try:
-            with open(token_path, "r") as f:
-                return f.read().strip()
-        except Exception as e:
-            logger.error(f"🚨 Error reading OAuth token: {e}")
-            raise
-    else:
-        logger.warning("⚠️ Running locally: No OAuth token file found. Falling back to password authentication.")
-        return None
-
-def get_connection_params():
-    """
-    Dynamically selects authentication method:
-    - OAuth authentication when running inside Snowflake Container Services.
-    - Username/password authentication when running locally.
-    """
-    token = get_login_token()
-
-    if token:
-        logger.debug("✅ Using OAuth authentication (inside Snowflake Container Services).")
-        return {
-            "account": SNOWFLAKE_ACCOUNT,
-            "host": SNOWFLAKE_HOST,
-            "authenticator": "oauth",
-            "token": token,
-            "warehouse": SNOWFLAKE_WAREHOUSE,
-            "database": SNOWFLAKE_DATABASE,
-            "schema": SNOWFLAKE_SCHEMA
-        }
-    else:
-        logger.debug("✅ Using username/password authentication (running locally).")
-        return {
-            "account": SNOWFLAKE_ACCOUNT,
-            "host": SNOWFLAKE_HOST,
-            "user": SNOWFLAKE_USER,
-            "password": SNOWFLAKE_PASSWORD,
-            "warehouse": SNOWFLAKE_WAREHOUSE,
-            "database": SNOWFLAKE_DATABASE,
-            "schema": SNOWFLAKE_SCHEMA
-        }
-
-def create_connection():
-    """Establish a Snowflake connection using the appropriate authentication method."""
-    try:
-        conn = snowflake.connector.connect(**get_connection_params())
-        logger.debug("✅ Snowflake connection established successfully!")
-        return conn
-    except Exception as e:
-        logger.error(f"🚨 Snowflake Connection Failed: {e}")
-        raise
-
-def get_snowflake_metadata(conn):
-    """Fetch metadata from Snowflake."""
-    logger.debug("Fetching Snowflake metadata...")
-    metadata_query = """
-        SELECT TABLE_NAME, COLUMN_NAME, DATA_TYPE
-        FROM INFORMATION_SCHEMA.COLUMNS;
-    """
-    try:
-        cursor = conn.cursor()
-        cursor.execute(metadata_query)
-        metadata_rows = cursor.fetchall()
-        cursor.close()
-
-        if not metadata_rows:
-            logger.warning("⚠️ No metadata retrieved! Check Snowflake permissions.")
-            return {}
-
-        metadata_df = pd.DataFrame(metadata_rows, columns=["TABLE_NAME", "COLUMN_NAME", "DATA_TYPE"])
-        metadata_dict = (
-            metadata_df.drop(columns=["TABLE_NAME"])
-            .groupby(metadata_df["TABLE_NAME"], group_keys=False)
-            .apply(lambda x: {col: dtype for col, dtype in zip(x["COLUMN_NAME"], x["DATA_TYPE"])}).
-            to_dict()
-        )
-        logger.debug("✅ Metadata retrieved successfully!")
-        return metadata_dict
-    except Exception as e:
-        logger.error(f"🚨 Error fetching metadata: {str(e)}")
-        return None
-
-def query_snowflake(conn, sql_query):
-    """Execute a SQL query in Snowflake."""
-    logger.debug(f"Executing SQL query: {sql_query}")
-    try:
-        cursor = conn.cursor()
-        cursor.execute(sql_query)
-        result = cursor.fetchall()
-        columns = [desc[0] for desc in cursor.description]
-        cursor.close()
-
-        if not result:
-            logger.warning("⚠️ Query returned no data!")
-            return pd.DataFrame()
-
-        logger.debug("✅ SQL query executed successfully!")
-        return pd.DataFrame(result, columns=columns)
-    except Exception as e:
-        logger.error(f"🚨 SQL Execution Error: {e}")
-        return pd.DataFrame({"Error": [str(e)]})
-
-def visual_generate(query, data, response):
-    """
-    Generate an interactive HTML chart from the query results.
-    Returns an HTML string or an empty string if generation fails.
-    """
-    logger.debug("Attempting to generate interactive HTML visualization...")
-    try:
-        df = pd.DataFrame(data)
-        if df.empty or len(df.columns) < 2:
-            logger.warning("⚠️ Not enough data to generate a chart.")
-            return ""
-        
-        fig = px.bar(df, x=df.columns[0], y=df.columns[1], title=response)
-        fig.update_layout(
-            plot_bgcolor="#2B2C2E",
-            paper_bgcolor="#2B2C2E",
-            font=dict(color="#FFFFFF"),
-        )
-        html_str = pio.to_html(fig, full_html=False)
-        logger.debug("✅ HTML visualization generated successfully!")
-        return html_str
-    except Exception as e:
-        logger.error(f"🚨 HTML chart generation error: {e}")
-        return ""
-
-__all__ = ["create_connection", "get_snowflake_metadata", "query_snowflake", "visual_generate", "llm"]
+import os
+import time
+import queue
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, asynccontextmanager
+import pandas as pd
+import snowflake.connector
+from snowflake.connector.errors import NotSupportedError
+import sqlglot
+from sqlglot import exp
+import plotly.express as px
+import plotly.io as pio
+import httpx
+from dotenv import load_dotenv
+from langchain_openai import AzureChatOpenAI
+from langchain_core.caches import InMemoryCache
+from langchain_core.globals import set_llm_cache
+import logging
+import sys
+
+# 🔹 Configure Logger (INFO by default; set LOG_LEVEL=DEBUG for verbose per-request logs)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+def get_logger(logger_name):
+    logger = logging.getLogger(logger_name)
+    logger.setLevel(LOG_LEVEL)
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setLevel(LOG_LEVEL)
+    handler.setFormatter(logging.Formatter('%(name)s [%(asctime)s] [%(levelname)s] %(message)s'))
+    logger.addHandler(handler)
+    return logger
+
+logger = get_logger('snowflake-service')
+
+# 🔹 Load environment variables
+logger.debug("Loading environment variables...")
+load_dotenv()
+
+# 🔹 Retrieve Azure OpenAI credentials
+api_key = os.getenv("OPENAI_API_KEY")
+deployment_name = os.getenv("AZURE_DEPLOYMENT_NAME")
+api_version = os.getenv("AZURE_API_VERSION")
+azure_endpoint = os.getenv("AZURE_ENDPOINT")
+
+# 🔹 Shared HTTP client: keep-alive + HTTP/2 multiplexing so concurrent LLM
+# calls reuse TLS sessions instead of paying a handshake per request
+_HTTP_ASYNC_CLIENT = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=200, max_keepalive_connections=100),
+    timeout=60,
+)
+
+# 🔹 Initialize Azure OpenAI
+logger.debug("Initializing Azure OpenAI Model...")
+try:
+    llm = AzureChatOpenAI(
+        openai_api_key=api_key,
+        azure_endpoint=azure_endpoint,
+        deployment_name=deployment_name,
+        api_version=api_version,
+        temperature=0.0,
+        http_async_client=_HTTP_ASYNC_CLIENT
+    )
+    logger.debug("✅ Azure OpenAI Model initialized successfully!")
+except Exception as e:
+    logger.error("🚨 Failed to Initialize Azure OpenAI Model: %s", e)
+    raise
+
+# 🔹 Cache LLM responses so repeated questions skip the Azure round-trip entirely.
+# Keyed on the full prompt (system prompt + question), so it covers both the
+# SQL-generation and the explanation calls.
+set_llm_cache(InMemoryCache())
+
+# 🔹 Retrieve Snowflake credentials (Ensure no password for OAuth inside Snowflake)
+SNOWFLAKE_USER = os.getenv("SNOWFLAKE_USER")
+SNOWFLAKE_PASSWORD = os.getenv("SNOWFLAKE_PASSWORD")  # Used for local testing
+SNOWFLAKE_ACCOUNT = os.getenv("SNOWFLAKE_ACCOUNT")
+SNOWFLAKE_WAREHOUSE = os.getenv("SNOWFLAKE_WAREHOUSE")
+SNOWFLAKE_DATABASE = os.getenv("SNOWFLAKE_DATABASE")
+SNOWFLAKE_SCHEMA = os.getenv("SNOWFLAKE_SCHEMA")
+SNOWFLAKE_HOST = os.getenv("SNOWFLAKE_HOST")
+
+def get_login_token():
+    """
+    Retrieve the short-lived Snowflake OAuth token if running inside Snowflake Container Services.
+    If running locally, return None.
+    """
+    token_path = "/snowflake/session/token"
+    if os.path.exists(token_path):
+        try:
+            with open(token_path, "r") as f:
+                return f.read().strip()
+        except Exception as e:
+            logger.error("🚨 Error reading OAuth token: %s", e)
+            raise
+    else:
+        logger.warning("⚠️ Running locally: No OAuth token file found. Falling back to password authentication.")
+        return None
+
+def get_connection_params():
+    """
+    Dynamically selects authentication method:
+    - OAuth authentication when running inside Snowflake Container Services.
+    - Username/password authentication when running locally.
+    """
+    token = get_login_token()
+
+    if token:
+        logger.debug("✅ Using OAuth authentication (inside Snowflake Container Services).")
+        return {
+            "account": SNOWFLAKE_ACCOUNT,
+            "host": SNOWFLAKE_HOST,
+            "authenticator": "oauth",
+            "token": token,
+            "warehouse": SNOWFLAKE_WAREHOUSE,
+            "database": SNOWFLAKE_DATABASE,
+            "schema": SNOWFLAKE_SCHEMA
+        }
+    else:
+        logger.debug("✅ Using username/password authentication (running locally).")
+        return {
+            "account": SNOWFLAKE_ACCOUNT,
+            "host": SNOWFLAKE_HOST,
+            "user": SNOWFLAKE_USER,
+            "password": SNOWFLAKE_PASSWORD,
+            "warehouse": SNOWFLAKE_WAREHOUSE,
+            "database": SNOWFLAKE_DATABASE,
+            "schema": SNOWFLAKE_SCHEMA
+        }
+
+def create_connection():
+    """Establish a Snowflake connection using the appropriate authentication method."""
+    try:
+        conn = snowflake.connector.connect(**get_connection_params())
+        logger.debug("✅ Snowflake connection established successfully!")
+        return conn
+    except Exception as e:
+        logger.error("🚨 Snowflake Connection Failed: %s", e)
+        raise
+
+# 🔹 Connection pool (Snowflake auth takes hundreds of ms; reuse sessions across requests)
+POOL_SIZE = int(os.getenv("SNOWFLAKE_POOL_SIZE", 5))
+_CONNECTION_POOL = queue.Queue(maxsize=POOL_SIZE)
+
+def _borrow_conn():
+    """Take a connection from the pool, creating one if none is available."""
+    try:
+        conn = _CONNECTION_POOL.get_nowait()
+        if conn.is_closed():
+            logger.debug("⚠️ Pooled connection was closed; creating a new one.")
+            conn = create_connection()
+        return conn
+    except queue.Empty:
+        return create_connection()
+
+def _return_conn(conn, broken):
+    """Return a connection to the pool, or close it if it may be broken."""
+    if broken:
+        try:
+            conn.close()
+        except Exception:
+            pass
+        return
+    try:
+        _CONNECTION_POOL.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+@contextmanager
+def get_conn():
+    """Borrow a Snowflake connection from the pool, creating one if none is available."""
+    conn = _borrow_conn()
+    broken = False
+    try:
+        yield conn
+    except BaseException:
+        # Don't return a possibly broken connection to the pool. BaseException
+        # also covers GeneratorExit/CancelledError from client disconnects,
+        # which would otherwise leak the connection entirely.
+        broken = True
+        raise
+    finally:
+        _return_conn(conn, broken)
+
+@asynccontextmanager
+async def aget_conn():
+    """Async variant of get_conn: the blocking borrow/return (Snowflake auth on
+    a pool miss, close on error) runs in a thread so the event loop isn't stalled."""
+    conn = await asyncio.to_thread(_borrow_conn)
+    broken = False
+    try:
+        yield conn
+    except BaseException:
+        broken = True
+        raise
+    finally:
+        await asyncio.to_thread(_return_conn, conn, broken)
+
+# 🔹 Metadata cache (schema changes rarely; avoid an INFORMATION_SCHEMA round-trip per request)
+METADATA_CACHE_TTL = int(os.getenv("METADATA_CACHE_TTL", 300))  # seconds
+_METADATA_CACHE = {"ts": 0.0, "data": None}
+
+# 🔹 Optional comma-separated allowlist restricting metadata to specific tables
+METADATA_TABLES = [
+    t.strip().upper() for t in os.getenv("SNOWFLAKE_METADATA_TABLES", "").split(",") if t.strip()
+]
+
+def get_snowflake_metadata(conn):
+    """Fetch metadata from Snowflake, reusing a cached copy within the TTL."""
+    if (
+        _METADATA_CACHE["data"] is not None
+        and time.monotonic() - _METADATA_CACHE["ts"] < METADATA_CACHE_TTL
+    ):
+        logger.debug("✅ Using cached Snowflake metadata.")
+        return _METADATA_CACHE["data"]
+
+    logger.debug("Fetching Snowflake metadata...")
+    # Filter server-side so the warehouse only returns the current schema's
+    # columns instead of the whole account
+    metadata_query = """
+        SELECT TABLE_NAME, COLUMN_NAME, DATA_TYPE
+        FROM INFORMATION_SCHEMA.COLUMNS
+        WHERE TABLE_SCHEMA = CURRENT_SCHEMA()
+          AND TABLE_CATALOG = CURRENT_DATABASE()
+    """
+    params = None
+    if METADATA_TABLES:
+        placeholders = ", ".join(["%s"] * len(METADATA_TABLES))
+        metadata_query += f" AND TABLE_NAME IN ({placeholders})"
+        params = METADATA_TABLES
+    try:
+        cursor = conn.cursor()
+        cursor.execute(metadata_query, params)
+        metadata_rows = cursor.fetchall()
+        cursor.close()
+
+        if not metadata_rows:
+            logger.warning("⚠️ No metadata retrieved! Check Snowflake permissions.")
+            return {}
+
+        # One pass over the rows — no DataFrame, no groupby, no per-group lambda
+        metadata_dict = {}
+        for table, column, dtype in metadata_rows:
+            metadata_dict.setdefault(table, {})[column] = dtype
+        _METADATA_CACHE["ts"] = time.monotonic()
+        _METADATA_CACHE["data"] = metadata_dict
+        logger.debug("✅ Metadata retrieved successfully!")
+        return metadata_dict
+    except Exception as e:
+        logger.error("🚨 Error fetching metadata: %s", e)
+        return None
+
+# 🔹 The only statement types the assistant may execute (CTEs parse as the
+# Select they wrap). Everything else — DML, DDL, CALL, COPY, GRANT and any
+# syntax sqlglot can't classify — is rejected.
+_ALLOWED_STATEMENTS = (exp.Select, exp.Union, exp.Intersect, exp.Except)
+
+def is_safe_select(sql_query):
+    """Return True if the LLM-generated SQL parses as read-only SELECT statements."""
+    try:
+        statements = sqlglot.parse(sql_query, read="snowflake")
+    except Exception as e:
+        logger.warning("⚠️ Could not parse generated SQL: %s", e)
+        return False
+
+    statements = [s for s in statements if s is not None]
+    if not statements:
+        logger.warning("⚠️ Rejected empty SQL statement: %s", sql_query)
+        return False
+    for parsed in statements:
+        if not isinstance(parsed, _ALLOWED_STATEMENTS):
+            logger.warning("⚠️ Rejected non-SELECT SQL statement: %s", sql_query)
+            return False
+    return True
+
+# 🔹 Threads used to download result-set batches in parallel (network IO releases the GIL)
+FETCH_WORKERS = int(os.getenv("SNOWFLAKE_FETCH_WORKERS", 8))
+
+def query_snowflake(conn, sql_query):
+    """Execute a SQL query in Snowflake."""
+    logger.debug("Executing SQL query: %s", sql_query)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(sql_query)
+        try:
+            # Arrow path: download result batches in parallel, then concatenate —
+            # no Python tuple churn and near-linear scaling with batch count
+            batches = cursor.get_result_batches()
+            if len(batches) > 1:
+                with ThreadPoolExecutor(max_workers=min(len(batches), FETCH_WORKERS)) as pool:
+                    frames = list(pool.map(lambda batch: batch.to_pandas(), batches))
+                result_df = pd.concat(frames, ignore_index=True)
+            else:
+                result_df = cursor.fetch_pandas_all()
+        except NotSupportedError:
+            # DDL/DML and other non-Arrow result sets fall back to the row path
+            result = cursor.fetchall()
+            columns = [desc[0] for desc in cursor.description]
+            result_df = pd.DataFrame(result, columns=columns)
+        cursor.close()
+
+        if result_df.empty:
+            logger.warning("⚠️ Query returned no data!")
+            return pd.DataFrame()
+
+        logger.debug("✅ SQL query executed successfully!")
+        return result_df
+    except Exception as e:
+        logger.error("🚨 SQL Execution Error: %s", e)
+        return pd.DataFrame({"Error": [str(e)]})
+
+def visual_generate(query, data, response):
+    """
+    Generate an interactive HTML chart from the query results.
+    Returns an HTML string or an empty string if generation fails.
+    """
+    logger.debug("Attempting to generate interactive HTML visualization...")
+    try:
+        df = pd.DataFrame(data)
+        if df.empty or len(df.columns) < 2:
+            logger.warning("⚠️ Not enough data to generate a chart.")
+            return ""
+        
+        fig = px.bar(df, x=df.columns[0], y=df.columns[1], title=response)
+        fig.update_layout(
+            plot_bgcolor="#2B2C2E",
+            paper_bgcolor="#2B2C2E",
+            font=dict(color="#FFFFFF"),
+        )
+        # Load plotly.js from the CDN instead of embedding the ~3MB bundle per response
+        html_str = pio.to_html(fig, full_html=False, include_plotlyjs="cdn")
+        logger.debug("✅ HTML visualization generated successfully!")
+        return html_str
+    except Exception as e:
+        logger.error("🚨 HTML chart generation error: %s", e)
+        return ""
+
+__all__ = ["create_connection", "get_conn", "aget_conn", "get_snowflake_metadata", "is_safe_select", "query_snowflake", "visual_generate", "llm"]